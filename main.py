@@ -1,11 +1,23 @@
 import os
 import sys
-import re
 import logging
+import hashlib
+import json
+import mmap
+import pickle
+import queue
+import signal
+import threading
 import multiprocessing
+import struct
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import OrderedDict, deque
+from logging.handlers import QueueListener
+from concurrent.futures import ThreadPoolExecutor
 
-from PyQt6.QtCore import QThread, pyqtSignal, QObject
+from PyQt6.QtCore import QThread, QTimer
 from PyQt6.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -15,18 +27,247 @@ from PyQt6.QtWidgets import (
     QFileDialog,
     QHBoxLayout,
     QVBoxLayout,
+    QPlainTextEdit,
     QProgressBar,
-    QTextEdit,
     QWidget,
 )
 
+import legendary
 from legendary.models.manifest import Manifest
 from legendary.models.json_manifest import JSONManifest
 from legendary.downloader.mp.manager import DLManager
 from legendary.models.downloading import UIUpdate
 
+MANIFEST_MAGIC = struct.pack("<I", Manifest.header_magic)
+STREAM_CHUNK_SIZE = 64 * 1024
+MMAP_MIN_SIZE = 16 * 1024 * 1024
+PARALLEL_FETCH_MIN_SIZE = 1024 * 1024
+MANIFEST_CACHE_VERSION = 1
+# pickles only load cleanly into the legendary classes that wrote them, so each version gets its own cache
+MANIFEST_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"),
+    ".cache",
+    "epic-manifest-downloader",
+    f"v{MANIFEST_CACHE_VERSION}-legendary-{legendary.__version__}",
+)
+MANIFEST_CACHE_SIZE = 4
+CONSOLE_MAX_LINES = 500
+CONSOLE_FLUSH_INTERVAL_MS = 100
+PROGRESS_INTERVAL_MS = 100
+STATUS_POLL_TIMEOUT = 0.5
+THREAD_SHUTDOWN_TIMEOUT_MS = 5000
+_INV_MB = 1.0 / 1048576.0
+
+SESSION = requests.Session()
+for _prefix in ("http://", "https://"):
+    SESSION.mount(
+        _prefix,
+        HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.5)),
+    )
+
+_MANIFEST_CACHE = OrderedDict()
+# url -> (cache key, conditional request headers) from the last download of that url,
+# persisted next to the pickles so a restarted app can still revalidate instead of re-downloading
+_MANIFEST_VALIDATORS = None
+_VALIDATORS_FILE = os.path.join(MANIFEST_CACHE_DIR, "validators.json")
+
+
+def _warm_connection(url):
+    # resolves DNS and finishes the TLS handshake so the pooled connection is ready for the manifest fetch
+    try:
+        SESSION.head(url, timeout=5)
+    except requests.RequestException:
+        pass
+
+
+def _read_into(resp, view):
+    # only valid for identity-encoded bodies, the raw stream is read without decoding.
+    # urllib3 reads into a temporary bytes of the requested size, so keep each call to one chunk
+    raw = resp.raw
+    offset = 0
+    while offset < len(view):
+        size = raw.readinto(view[offset:offset + STREAM_CHUNK_SIZE])
+        if not size:
+            break
+        offset += size
+    return offset
+
+
+def _stream_fetch(url):
+    with SESSION.get(url, stream=True, timeout=(5, 30)) as resp:
+        resp.raise_for_status()
+        total = int(resp.headers.get("Content-Length", 0))
+        if resp.headers.get("Content-Encoding", "identity") != "identity":
+            # Content-Length is the encoded size, it can't be used to size the buffer
+            total = 0
+
+        if not total:
+            data = bytearray()
+            for chunk in resp.iter_content(STREAM_CHUNK_SIZE):
+                data.extend(chunk)
+            return data, resp
+
+        data = bytearray(total)
+        offset = _read_into(resp, memoryview(data))
+        if offset != total:
+            raise ValueError(f"Manifest download incomplete: got {offset} of {total} bytes")
+        return data, resp
+
+
+def _fetch_range(url, view, lo, hi, if_range=None):
+    # returns False when the server answered with something other than the pinned range,
+    # either because it doesn't really do ranges or because the manifest changed since the HEAD
+    headers = {"Range": f"bytes={lo}-{hi}", "Accept-Encoding": "identity"}
+    if if_range:
+        headers["If-Range"] = if_range
+    with SESSION.get(url, headers=headers, stream=True, timeout=(5, 30)) as resp:
+        resp.raise_for_status()
+        if resp.status_code != 206 or resp.headers.get("Content-Encoding", "identity") != "identity":
+            return False
+        size = _read_into(resp, view[lo:hi + 1])
+        if size != hi + 1 - lo:
+            raise ValueError(f"Range {lo}-{hi} incomplete: got {size} bytes")
+        return True
+
+
+def _parallel_fetch(url, n=4, chunk=4 * 1024 * 1024, headers=None):
+    head = SESSION.head(
+        url, headers={"Accept-Encoding": "identity", **(headers or {})}, allow_redirects=True, timeout=(5, 30)
+    )
+    if head.status_code == 304:
+        return None, head
+    total = int(head.headers.get("Content-Length", 0))
+    if (
+        not head.ok
+        or head.headers.get("Accept-Ranges") != "bytes"
+        or total < PARALLEL_FETCH_MIN_SIZE
+    ):
+        return _stream_fetch(url)
+
+    # If-Range pins every range to the version the HEAD described, it needs a strong validator
+    etag = head.headers.get("ETag", "")
+    if_range = etag if etag and not etag.startswith("W/") else head.headers.get("Last-Modified")
+
+    # every range writes straight into its own slice of the shared buffer
+    data = bytearray(total)
+    view = memoryview(data)
+    ranges = [(lo, min(lo + chunk, total) - 1) for lo in range(0, total, chunk)]
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        futures = [pool.submit(_fetch_range, head.url, view, lo, hi, if_range) for lo, hi in ranges]
+        complete = all(future.result() for future in futures)
+        if not complete:
+            for future in futures:
+                future.cancel()
+    if not complete:
+        logging.info("Ranged manifest download not usable, falling back to a single request.")
+        return _stream_fetch(url)
+    return data, head
+
+
+def _map_file(path):
+    with open(path, "rb") as manifest_file:
+        mapped = mmap.mmap(manifest_file.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+def _read_json_manifest(data):
+    # JSONManifest.read decodes its input, which a memory map can't do
+    return JSONManifest.read_all(data[:] if isinstance(data, mmap.mmap) else data)
+
+
+def _write_atomic(path, write):
+    os.makedirs(MANIFEST_CACHE_DIR, exist_ok=True)
+    with open(path + ".tmp", "wb") as cache_file:
+        write(cache_file)
+    os.replace(path + ".tmp", path)
+
+
+def _validators():
+    global _MANIFEST_VALIDATORS
+    if _MANIFEST_VALIDATORS is None:
+        try:
+            with open(_VALIDATORS_FILE, "rb") as validators_file:
+                _MANIFEST_VALIDATORS = json.load(validators_file)
+        except FileNotFoundError:
+            _MANIFEST_VALIDATORS = {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable manifest validators: {e}")
+            _MANIFEST_VALIDATORS = {}
+    return _MANIFEST_VALIDATORS
+
+
+def _save_validators():
+    try:
+        _write_atomic(_VALIDATORS_FILE, lambda f: f.write(json.dumps(_validators()).encode()))
+    except OSError as e:
+        logging.warning(f"Failed to write manifest validators: {e}")
+
+
+def _prune_disk_cache():
+    # keep the most recently used pickles, drop the rest and any validators pointing at them
+    try:
+        entries = [entry for entry in os.scandir(MANIFEST_CACHE_DIR) if entry.name.endswith(".pkl")]
+    except OSError:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    stale = set()
+    for entry in entries[MANIFEST_CACHE_SIZE:]:
+        try:
+            os.remove(entry.path)
+        except OSError as e:
+            logging.warning(f"Failed to remove manifest cache entry {entry.name}: {e}")
+            continue
+        stale.add(entry.name[:-len(".pkl")])
+
+    validators = _validators()
+    stale_urls = [url for url, (key, _) in validators.items() if key in stale]
+    for url in stale_urls:
+        del validators[url]
+    if stale_urls:
+        _save_validators()
+
+
+def _cache_get(key):
+    manifest = _MANIFEST_CACHE.get(key)
+    if manifest is not None:
+        _MANIFEST_CACHE.move_to_end(key)
+        return manifest
+    path = os.path.join(MANIFEST_CACHE_DIR, f"{key}.pkl")
+    try:
+        with open(path, "rb") as cache_file:
+            manifest = pickle.load(cache_file)
+        # mtime doubles as last use for pruning
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable manifest cache entry {key}: {e}")
+        return None
+    _cache_put(key, manifest, persist=False)
+    return manifest
+
+
+def _cache_put(key, manifest, persist=True):
+    _MANIFEST_CACHE[key] = manifest
+    _MANIFEST_CACHE.move_to_end(key)
+    while len(_MANIFEST_CACHE) > MANIFEST_CACHE_SIZE:
+        _MANIFEST_CACHE.popitem(last=False)
+    if not persist:
+        return
+    path = os.path.join(MANIFEST_CACHE_DIR, f"{key}.pkl")
+    try:
+        _write_atomic(path, lambda f: pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError as e:
+        logging.warning(f"Failed to write manifest cache: {e}")
+        return
+    _prune_disk_cache()
+
 
 class WorkInfo:
+    __slots__ = ("base_url", "manifest", "download_location")
+
     def __init__(self, base_url="", manifest="", download_location=""):
         self.base_url = base_url
         self.manifest = manifest
@@ -34,75 +275,150 @@ class WorkInfo:
 
 
 class UpdateProgress:
-    def __init__(self, callback):
-        self.callback = callback
+    __slots__ = ("latest",)
+
+    def __init__(self):
+        self.latest = None
 
     def put(self, item, timeout=None):
-        self.callback(item)
+        # only the newest update is ever shown, so it simply replaces any unread one
+        self.latest = item
 
 
-class DownloadThread(QThread):
-    progress_signal = pyqtSignal(float, float, float, float)
-    url_regex = re.compile("^https?://(?:www\\.)?[-a-zA-Z0-9@:%._\\+~#=]{1,256}\\.[a-zA-Z0-9()]{1,6}\\b(?:[-a-zA-Z0-9()@:%_\\+.~#?&=/]*)$")
+class DownloadManagerProcess(DLManager):
+    def run(self):
+        if hasattr(os, "setpgrp"):
+            # lead a process group so kill() can interrupt the manager and the workers it forks together
+            os.setpgrp()
+        super().run()
 
+
+class DownloadThread(QThread):
     def __init__(self, url, work_info: WorkInfo):
         super().__init__()
         self.url = url
         self.work_info = work_info
-        self.progress_queue = UpdateProgress(self.update_progress)
-        self.manager = DLManager(
-            os.path.join(self.work_info.download_location),
+        self.progress_queue = UpdateProgress()
+        self.status_queue = multiprocessing.Queue()
+        self.logging_queue = multiprocessing.Queue()
+        base = self.work_info.download_location
+        self.manager = DownloadManagerProcess(
+            base,
             self.work_info.base_url,
-            os.path.join(self.work_info.download_location, ".cache"),
-            self.progress_queue,
-            resume_file=os.path.join(self.work_info.download_location, ".resumedata"),
+            base + os.sep + ".cache",
+            self.status_queue,
+            resume_file=base + os.sep + ".resumedata",
         )
+        self.manager.logging_queue = self.logging_queue
+        self.cancelled = False
 
     def run(self):
+        # the manager and its workers log through a queue, relay that to this process's handlers
+        listener = QueueListener(self.logging_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        listener.start()
         try:
-            manifest_data = self.download_manifest()
-            manifest = self.parse_manifest(manifest_data)
+            manifest = self.load_manifest()
             self.manager.run_analysis(manifest, None, processing_optimization=False)
-            self.manager.run()
+            if self.cancelled:
+                return
+            # running the manager as its own process, like legendary's CLI does, is what lets kill() stop it:
+            # its download loop never checks `running`
+            self.manager.start()
+            while self.manager.is_alive():
+                self.relay_progress()
+            self.relay_progress()
         except Exception as e:
             logging.error(f"Error occurred during download: {e}")
             self.handle_error(f"Error occurred during download: {e}")
         finally:
+            listener.stop()
             self.finished.emit()
 
-    def download_manifest(self):
-        if self.url_regex.match(self.work_info.manifest):
+    def relay_progress(self):
+        # only the newest update is shown, so drain whatever queued up behind the first one
+        try:
+            self.progress_queue.put(self.status_queue.get(timeout=STATUS_POLL_TIMEOUT))
+            while True:
+                self.progress_queue.put(self.status_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+    def load_manifest(self):
+        location = self.work_info.manifest
+        head = None
+        if location.startswith(("http://", "https://")):
             logging.info("Downloading manifest from URL...")
-            resp = requests.get(self.work_info.manifest, stream=True)
-            return resp.content
+            key, conditional = _validators().get(location, (None, None))
+            data, head = _parallel_fetch(location, headers=conditional)
+            if data is None:
+                manifest = _cache_get(key)
+                if manifest is not None:
+                    logging.info("Manifest not modified, using cached copy.")
+                    return manifest
+                data, head = _parallel_fetch(location)
+        elif os.path.getsize(location) >= MMAP_MIN_SIZE:
+            data = _map_file(location)
         else:
-            with open(self.work_info.manifest, "rb") as manifest_file:
-                return manifest_file.read()
+            with open(location, "rb") as manifest_file:
+                data = manifest_file.read()
+
+        try:
+            key = hashlib.blake2b(data, digest_size=16).hexdigest()
+            manifest = _cache_get(key)
+            if manifest is None:
+                manifest = self.parse_manifest(data)
+                _cache_put(key, manifest)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+        if head is not None:
+            conditional = {}
+            if etag := head.headers.get("ETag"):
+                conditional["If-None-Match"] = etag
+            if last_modified := head.headers.get("Last-Modified"):
+                conditional["If-Modified-Since"] = last_modified
+            if conditional and _validators().get(location) != [key, conditional]:
+                _validators()[location] = [key, conditional]
+                _save_validators()
+        return manifest
 
     def parse_manifest(self, data):
+        # binary manifests open with a fixed magic, JSON ones with an object or array
+        if data[:4] == MANIFEST_MAGIC:
+            parser = Manifest.read_all
+        elif bytes(data[:64]).lstrip()[:1] in (b"{", b"["):
+            parser = _read_json_manifest
+        else:
+            parser = None
+
         try:
-            return Manifest.read_all(data)
-        except Exception:
+            if parser is not None:
+                return parser(data)
             try:
-                return JSONManifest.read_all(data)
-            except Exception as e:
-                logging.error(f"Error parsing manifest: {e}")
-                self.handle_error(f"Error parsing manifest: {e}")
-                raise
-
-    def update_progress(self, progress: UIUpdate):
-        if progress:
-            mbs = progress.download_speed / 1024 / 1024
-            self.progress_signal.emit(
-                progress.progress,
-                mbs,
-                progress.read_speed / 1024 / 1024,
-                progress.write_speed / 1024 / 1024,
-            )
+                return Manifest.read_all(data)
+            except Exception:
+                return _read_json_manifest(data)
+        except Exception as e:
+            logging.error(f"Error parsing manifest: {e}")
+            self.handle_error(f"Error parsing manifest: {e}")
+            raise
 
     def kill(self):
-        import signal
-        os.kill(self.manager._parent_pid, signal.SIGTERM)
+        self.cancelled = True
+        if not self.manager.is_alive():
+            return
+        if not hasattr(os, "killpg"):
+            # no process groups to interrupt, the workers are left to the OS
+            self.manager.terminate()
+            return
+        # legendary tears down its threads, workers and queues on KeyboardInterrupt,
+        # the workers share the manager's group so they are interrupted with it
+        try:
+            os.killpg(self.manager.pid, signal.SIGINT)
+        except ProcessLookupError:
+            # the manager hasn't made its group yet, so it has no workers either
+            os.kill(self.manager.pid, signal.SIGINT)
 
     def handle_error(self, message):
         logging.error(message)
@@ -118,6 +434,7 @@ class MainWindow(QMainWindow):
         self.setup_layouts()
         self.setup_connections()
         self.setup_logging()
+        self.warm_connection(self.url_edit.text())
 
         self.setWindowTitle("Epic Manifest Downloader")
         self.setMinimumSize(500, 380)
@@ -138,9 +455,12 @@ class MainWindow(QMainWindow):
         self.progress_bar.setValue(0)
         self.progress_label = QLabel()
         self.speed_label = QLabel()
-        self.console = QTextEdit()
+        self.console = QPlainTextEdit()
         self.console.setReadOnly(True)
+        self.console.setMaximumBlockCount(CONSOLE_MAX_LINES)
         self.download_thread = None
+        self._last_progress = None
+        self.progress_timer = QTimer(self)
 
     def setup_layouts(self):
         input_layout = QVBoxLayout()
@@ -184,6 +504,15 @@ class MainWindow(QMainWindow):
         self.manifest_picker_button.clicked.connect(self.select_manifest)
         self.download_location_button.clicked.connect(self.browse_download_location)
         self.download_button.clicked.connect(self.download_file)
+        self.progress_timer.timeout.connect(self.poll_progress)
+        self.url_edit.editingFinished.connect(lambda: self.warm_connection(self.url_edit.text()))
+        self.manifest_location_edit.editingFinished.connect(
+            lambda: self.warm_connection(self.manifest_location_edit.text())
+        )
+
+    def warm_connection(self, url):
+        if url.startswith(("http://", "https://")):
+            threading.Thread(target=_warm_connection, args=(url,), daemon=True).start()
 
     def select_manifest(self):
         manifest_path, _ = QFileDialog.getOpenFileName(
@@ -210,56 +539,87 @@ class MainWindow(QMainWindow):
         work_info = WorkInfo(url, manifest_path, dest_dir)
 
         self.download_thread = DownloadThread(url, work_info)
-        self.download_thread.progress_signal.connect(self.update_progress)
         self.download_thread.finished.connect(self.download_finished)
         self.download_thread.start()
+        self._last_progress = None
+        self.progress_timer.start(PROGRESS_INTERVAL_MS)
         self.download_button.setEnabled(False)
 
+    def poll_progress(self):
+        progress: UIUpdate = self.download_thread.progress_queue.latest
+        if progress is None or progress is self._last_progress:
+            return
+        self._last_progress = progress
+        self.update_progress(
+            progress.progress,
+            progress.download_speed * _INV_MB,
+            progress.read_speed * _INV_MB,
+            progress.write_speed * _INV_MB,
+        )
+
     def update_progress(self, progress_percent, speed, read_speed, write_speed):
-        self.progress_bar.setValue(int(progress_percent))
+        value = int(progress_percent)
+        if value != self.progress_bar.value():
+            self.progress_bar.setValue(value)
         self.speed_label.setText(f"Download {speed:.2f} MB/s")
         self.progress_label.setText(
             f"R/W {read_speed:.2f} MB/s, {write_speed:.2f} MB/s"
         )
 
     def download_finished(self):
+        self.progress_timer.stop()
         self.download_button.setEnabled(True)
         self.progress_bar.setValue(0)
         self.progress_label.setText("Download Finished!")
         self.speed_label.setText("")
         if self.download_thread:
-            self.download_thread.manager.running = False
             self.download_thread.kill()
 
     def write_to_console(self, text: str):
         text = text[:-1] if text.endswith("\n") else text
-        self.console.append(text)
+        self.console.appendPlainText(text)
+
+    def flush_console(self):
+        lines = self.log_handler.lines
+        batch = []
+        try:
+            while True:
+                batch.append(lines.popleft())
+        except IndexError:
+            pass
+        if batch:
+            self.console.appendPlainText("\n".join(batch))
 
     def setup_logging(self):
-        stream = LoggerStream()
-        stream.newText.connect(self.write_to_console)
+        self.log_handler = ConsoleLogHandler()
+        self.console_timer = QTimer(self)
+        self.console_timer.timeout.connect(self.flush_console)
+        self.console_timer.start(CONSOLE_FLUSH_INTERVAL_MS)
 
         logging.basicConfig(level=logging.INFO)
         dlm = logging.getLogger("DLM")
         dlm.setLevel(logging.INFO)
 
-        logging.getLogger().addHandler(logging.StreamHandler(stream))
+        logging.getLogger().addHandler(self.log_handler)
 
     def closeEvent(self, event):
         if self.download_thread:
-            self.download_thread.manager.running = False
             self.download_thread.kill()
+            self.download_thread.wait(THREAD_SHUTDOWN_TIMEOUT_MS)
         super().closeEvent(event)
 
 
-class LoggerStream(QObject):
-    newText = pyqtSignal(str)
+class ConsoleLogHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        # the console only keeps CONSOLE_MAX_LINES anyway, so older unflushed lines can be dropped here
+        self.lines = deque(maxlen=CONSOLE_MAX_LINES)
 
-    def write(self, text):
-        self.newText.emit(str(text))
-
-    def flush(self):
-        pass
+    def emit(self, record):
+        try:
+            self.lines.append(self.format(record))
+        except Exception:
+            self.handleError(record)
 
 
 if __name__ == "__main__":